@@ -1,16 +1,26 @@
 import os
+import re
+import math
+import errno
 import sys
-import base64
 import logging
+import uuid
+import shutil
+import hashlib
+import functools
 import asyncio
 import tempfile
 import subprocess
-from typing import Dict, Any, Optional, List
+from typing import AsyncIterator, Dict, Any, Optional, List, Tuple
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from pathlib import Path
+import pybase64
 from fastapi import FastAPI, Form, HTTPException, Response, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, JSONResponse
 from pydantic import BaseModel, Field
+from starlette.background import BackgroundTask
 
 # Configure logging
 logging.basicConfig(
@@ -19,7 +29,191 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="LaTeX Compiler Service")
+# pdflatex is rerun only while the previous pass asks for it, either through
+# a warning near the end of the log or by changing a contents list it reads back
+MAX_PDFLATEX_PASSES = 3
+LOG_TAIL_BYTES = 32 * 1024
+_RERUN_RE = re.compile(rb'rerun to get|rerun latex|label\(s\) may have changed', re.I)
+_CONTENTS_EXTENSIONS = ("toc", "lof", "lot")
+
+# Limits checked before any disk or subprocess work
+MAX_TEX_LENGTH = 2_000_000
+MAX_MACRO_DEFINITIONS = 5_000
+PDFLATEX_TIMEOUT = 60
+# Primitives that open arbitrary files or run shell commands, and inputs that
+# name an absolute or parent-directory path, are rejected unless
+# LATEX_ALLOW_FILE_IO=1. This is only a first filter: pdflatex itself runs
+# without shell escape and with paranoid file access.
+ALLOW_FILE_IO = os.environ.get("LATEX_ALLOW_FILE_IO") == "1"
+_FILE_IO_COMMANDS = frozenset({"openin", "openout", "write18"})
+# A control word ends at the first non-letter, so "\openin5" is \openin.
+_GUARDED_COMMAND_RE = re.compile(
+    r'\\(?:(?P<command>def|edef|gdef|xdef|let|expandafter|openin|openout)(?![A-Za-z])'
+    r'|(?P<input>input|include|@input|@iinput|InputIfFileExists)(?![A-Za-z])'
+    r'\s*(?:\{(?P<braced>[^{}]*)\}|"(?P<quoted>[^"]*)"|(?P<bare>[^\s{}%\\]*))'
+    r'|write\s*(?P<write18>18))'
+)
+# A % not escaped by an odd number of backslashes starts a comment
+_COMMENT_RE = re.compile(r'(?<!\\)((?:\\\\)*)%[^\n]*')
+_PDFLATEX_ENV = {**os.environ, "openin_any": "p", "openout_any": "p"}
+
+# Maps lone carriage returns to newlines and drops other control characters
+_CONTROL_CHAR_TABLE = {c: None for c in range(0x20) if c not in (0x09, 0x0A)}
+_CONTROL_CHAR_TABLE[0x0D] = '\n'
+
+# Document structure markers
+DOC_CLASS = '\\documentclass'
+BEGIN_DOC = '\\begin{document}'
+END_DOC = '\\end{document}'
+_HAS_DOCCLASS_RE = re.compile(r'^\s*\\documentclass', re.M)
+
+# Preamble commands after which a missing \begin{document} is inserted
+_PREAMBLE_RE = re.compile(r'\\(?:documentclass|usepackage|newcommand)\b')
+
+# Working directories are reused across requests and kept on tmpfs if possible;
+# they only hold in-flight compiles, so a modest /dev/shm is enough
+WORK_DIR_ROOT = os.environ.get("LATEX_WORK_DIR") or os.path.join(
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+    'latex-pool'
+)
+
+# Compiled PDFs are cached on disk by a hash of the submitted LaTeX source.
+# Unless LATEX_CACHE_MAX_BYTES is set, the byte budget is a fraction of the
+# free space at startup, capped at PDF_CACHE_DEFAULT_MAX_BYTES.
+PDF_CACHE_ROOT = os.environ.get("LATEX_CACHE_DIR") or os.path.join(
+    tempfile.gettempdir(), 'latex-cache'
+)
+PDF_CACHE_SIZE = 256
+PDF_CACHE_DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+PDF_CACHE_FREE_FRACTION = 0.25
+PDF_CACHE_MAX_BYTES = (
+    int(os.environ["LATEX_CACHE_MAX_BYTES"])
+    if os.environ.get("LATEX_CACHE_MAX_BYTES") else None
+)
+def _cgroup_cpu_quota() -> Optional[int]:
+    """Whole CPUs granted by a cgroup CFS quota, if one is set"""
+    try:
+        quota, period = Path('/sys/fs/cgroup/cpu.max').read_text().split()
+        if quota != 'max':
+            return max(1, math.ceil(int(quota) / int(period)))
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        quota = int(Path('/sys/fs/cgroup/cpu/cpu.cfs_quota_us').read_text())
+        period = int(Path('/sys/fs/cgroup/cpu/cpu.cfs_period_us').read_text())
+        if quota > 0:
+            return max(1, math.ceil(quota / period))
+    except (OSError, ValueError):
+        pass
+    return None
+
+def _work_dir_cpus() -> List[Optional[int]]:
+    """CPU for each pool slot; None means the slot's pdflatex runs are not pinned
+
+    The pool size comes from LATEX_POOL_SIZE, else the cgroup CPU quota, else
+    the affinity mask. A quota (e.g. Cloud Run, docker --cpus) limits CPU time
+    but not which host CPUs are used, and sched_getaffinity still reports all
+    of them, so slots are only pinned when they map one-to-one onto that mask.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        cpus: List[Optional[int]] = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = [None] * (os.cpu_count() or 1)
+    size = int(os.environ.get("LATEX_POOL_SIZE") or 0) or _cgroup_cpu_quota() or len(cpus)
+    if size != len(cpus):
+        return [None] * size
+    return cpus
+
+WORK_DIR_CPUS = _work_dir_cpus()
+
+class WorkDirPool:
+    """Pool of pre-created compilation directories shared between requests
+
+    Each directory is paired with the CPU that pdflatex runs in it are pinned to.
+    Outgoing PDFs are staged under ``output_root``, which should share a
+    filesystem with the PDF cache so cached files can be hard-linked.
+    """
+    def __init__(self, root: str, cpus: List[Optional[int]], output_root: str):
+        self.root = root
+        self.cpus = cpus
+        self.output_root = output_root
+        self.output_dir: Optional[str] = None
+        self._queue: Optional[asyncio.Queue] = None
+
+    def open(self):
+        """Create the pool directories and the directory for outgoing PDFs"""
+        os.makedirs(self.root, exist_ok=True)
+        os.makedirs(self.output_root, exist_ok=True)
+        self.output_dir = tempfile.mkdtemp(prefix="output-", dir=self.output_root)
+        self._queue = asyncio.Queue()
+        for cpu in self.cpus:
+            self._queue.put_nowait((tempfile.mkdtemp(prefix="work-", dir=self.root), cpu))
+        logger.info(f"Created {len(self.cpus)} working directories in {self.root}")
+
+    def close(self):
+        """Remove all idle pool directories and any unsent PDFs"""
+        while self._queue is not None and not self._queue.empty():
+            temp_dir, _ = self._queue.get_nowait()
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        self._queue = None
+        if self.output_dir is not None:
+            shutil.rmtree(self.output_dir, ignore_errors=True)
+            self.output_dir = None
+
+    def _reset(self, temp_dir: str) -> str:
+        """Empty a directory for reuse, replacing it if it cannot be cleaned"""
+        try:
+            with os.scandir(temp_dir) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path)
+                    else:
+                        os.unlink(entry.path)
+            return temp_dir
+        except Exception as e:
+            logger.error(f"Failed to clean working directory {temp_dir}: {e}")
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            return tempfile.mkdtemp(prefix="work-", dir=self.root)
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[Tuple[str, Optional[int]]]:
+        """Borrow an empty working directory and its CPU for a compile"""
+        if self._queue is None:
+            raise RuntimeError("Working directory pool is not open")
+        temp_dir, cpu = await self._queue.get()
+        try:
+            yield temp_dir, cpu
+        finally:
+            self._queue.put_nowait((self._reset(temp_dir), cpu))
+
+work_dirs = WorkDirPool(WORK_DIR_ROOT, WORK_DIR_CPUS, PDF_CACHE_ROOT)
+
+# Cleaned sources are memoised by count; larger inputs bypass the cache
+PREPARE_CACHE_SIZE = 128
+PREPARE_CACHE_MAX_LENGTH = 100_000
+
+# Minimal document compiled once at startup to warm the TeX caches
+WARM_UP_DOCUMENT = "\\documentclass{article}\n\\begin{document}\nwarm-up\n\\end{document}"
+
+async def warm_up_pdflatex():
+    """Load the format, class and font files into the page cache before serving"""
+    result = await compile_latex(WARM_UP_DOCUMENT)
+    if result.get("success"):
+        logger.info("pdflatex warm-up compile succeeded")
+    else:
+        logger.warning(f"pdflatex warm-up compile failed: {result.get('error')}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    work_dirs.open()
+    pdf_cache.open()
+    await warm_up_pdflatex()
+    yield
+    pdf_cache.close()
+    work_dirs.close()
+
+app = FastAPI(title="LaTeX Compiler Service", lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -38,86 +232,136 @@ class CompilationError(Exception):
         self.output = output
         super().__init__(self.message)
 
+def check_tex_length(content: str):
+    """Reject input that is too large to be worth hashing or cleaning"""
+    if len(content) > MAX_TEX_LENGTH:
+        raise ValueError(f"LaTeX content exceeds {MAX_TEX_LENGTH} characters")
+
+def _strip_comments(content: str) -> str:
+    # Comments can only be trusted while % keeps its usual category code
+    if "\\catcode" in content:
+        return content
+    return _COMMENT_RE.sub(r'\1', content)
+
+def _is_outside_path(path: str) -> bool:
+    path = path.strip()
+    return path.startswith(("/", "~")) or ".." in path.split("/")
+
+def check_tex_content(content: str):
+    """Reject input that uses disallowed primitives or too many definitions"""
+    definitions = 0
+    for match in _GUARDED_COMMAND_RE.finditer(_strip_comments(content)):
+        if match.group("input"):
+            path = match.group("braced") or match.group("quoted") or match.group("bare") or ""
+            if _is_outside_path(path) and not ALLOW_FILE_IO:
+                raise ValueError(f"\\{match.group('input')} outside the working directory is not allowed")
+            continue
+
+        command = match.group("command") or "write18"
+        if command in _FILE_IO_COMMANDS:
+            if not ALLOW_FILE_IO:
+                raise ValueError(f"\\{command} is not allowed")
+        else:
+            definitions += 1
+            if definitions > MAX_MACRO_DEFINITIONS:
+                raise ValueError(f"LaTeX content exceeds {MAX_MACRO_DEFINITIONS} macro definitions")
+
 class LatexCompiler:
-    def __init__(self, temp_dir: str):
+    def __init__(self, temp_dir: str, cpu: Optional[int] = None):
         self.temp_dir = temp_dir
+        self.cpu = cpu
         self.tex_file = os.path.join(temp_dir, "document.tex")
         self.pdf_file = os.path.join(temp_dir, "document.pdf")
         self.log_file = os.path.join(temp_dir, "document.log")
         self.aux_file = os.path.join(temp_dir, "document.aux")
 
-    def validate_tex_content(self, content: str) -> str:
+    @staticmethod
+    def validate_tex_content(content: str) -> str:
         """Validate and clean LaTeX content"""
         if not content or not content.strip():
             raise ValueError("Empty LaTeX content")
         
-        # Normalize line endings
-        content = content.replace('\r\n', '\n').replace('\r', '\n')
-        
-        # Remove any Unicode control characters
-        content = ''.join(char for char in content if char >= ' ' or char in ['\n', '\t'])
+        # Normalize line endings and remove any Unicode control characters
+        content = content.replace('\r\n', '\n').translate(_CONTROL_CHAR_TABLE)
         
         return content.strip()
 
-    def ensure_document_structure(self, content: str) -> str:
+    @staticmethod
+    def ensure_document_structure(content: str) -> str:
         """Ensure LaTeX content has proper document structure"""
-        lines = content.split('\n')
-        
         # Add document class if missing
-        if not any(line.strip().startswith('\\documentclass') for line in lines):
-            content = '\\documentclass{article}\n' + content
+        if _HAS_DOCCLASS_RE.search(content) is None:
+            content = DOC_CLASS + '{article}\n' + content
         
         # Add document environment if missing
-        if '\\begin{document}' not in content:
-            if '\\documentclass' in content:
-                # Add after documentclass and any potential preamble commands
-                preamble_end = max(
-                    content.rfind('\\documentclass'),
-                    content.rfind('\\usepackage'),
-                    content.rfind('\\newcommand')
-                )
-                if preamble_end != -1:
-                    preamble_end = content.find('\n', preamble_end) + 1
-                    content = content[:preamble_end] + '\n\\begin{document}\n' + content[preamble_end:]
+        if BEGIN_DOC not in content:
+            # A \documentclass is present by now, so add after it and any
+            # potential preamble commands
+            last_command = None
+            for last_command in _PREAMBLE_RE.finditer(content):
+                pass
+            if last_command is not None:
+                preamble_end = content.find('\n', last_command.end())
+                preamble_end = len(content) if preamble_end == -1 else preamble_end + 1
+                content = content[:preamble_end] + '\n' + BEGIN_DOC + '\n' + content[preamble_end:]
             else:
-                content = content + '\n\\begin{document}\n'
+                content = content + '\n' + BEGIN_DOC + '\n'
         
-        if '\\end{document}' not in content:
-            content = content + '\n\\end{document}'
+        if END_DOC not in content:
+            content = content + '\n' + END_DOC
         
         return content
 
     async def write_tex_file(self, content: str):
         """Write LaTeX content to file with proper encoding"""
         try:
-            with open(self.tex_file, "w", encoding="utf-8") as f:
-                f.write(content)
+            # Newlines are already normalized, so skip the text I/O layer
+            Path(self.tex_file).write_bytes(content.encode("utf-8"))
             logger.info(f"Successfully wrote LaTeX content to {self.tex_file}")
         except Exception as e:
             raise CompilationError(f"Failed to write LaTeX file: {str(e)}")
 
-    async def run_pdflatex(self) -> tuple[str, str, int | None]:
-        """Run pdflatex with proper error handling"""
+    async def run_pdflatex(self) -> tuple[bytes, bytes, int | None]:
+        """Run pdflatex with proper error handling, returning undecoded output"""
         try:
             process = await asyncio.create_subprocess_exec(
                 "pdflatex",
                 "-interaction=nonstopmode",
                 "-halt-on-error",
+                "-no-shell-escape",
                 self.tex_file,
                 cwd=self.temp_dir,
+                env=_PDFLATEX_ENV,
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.PIPE
             )
-            stdout_bytes, stderr_bytes = await process.communicate()
-            
-            # Safely decode output
-            stdout = stdout_bytes.decode('utf-8', errors='replace')
-            stderr = stderr_bytes.decode('utf-8', errors='replace')
-            
+            self.pin_process(process.pid)
+            try:
+                stdout, stderr = await asyncio.wait_for(
+                    process.communicate(), timeout=PDFLATEX_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                raise CompilationError(
+                    f"pdflatex timed out after {PDFLATEX_TIMEOUT} seconds",
+                    log=await self.read_log_file()
+                )
             return stdout, stderr, process.returncode
+        except CompilationError:
+            raise
         except Exception as e:
             raise CompilationError(f"Failed to run pdflatex: {str(e)}")
 
+    def pin_process(self, pid: int):
+        """Pin a process to this compiler's CPU so its caches stay warm"""
+        if self.cpu is None:
+            return
+        try:
+            os.sched_setaffinity(pid, {self.cpu})
+        except OSError as e:
+            logger.warning(f"Failed to pin pdflatex to CPU {self.cpu}: {e}")
+
     async def read_log_file(self) -> str:
         """Read and parse LaTeX log file"""
         try:
@@ -129,6 +373,32 @@ class LatexCompiler:
             logger.error(f"Failed to read log file: {e}")
             return ""
 
+    async def read_log_tail(self) -> bytes:
+        """Read the end of the raw log, where end-of-run warnings are written"""
+        try:
+            with open(self.log_file, "rb") as f:
+                f.seek(0, os.SEEK_END)
+                f.seek(max(0, f.tell() - LOG_TAIL_BYTES))
+                return f.read()
+        except OSError:
+            return b""
+
+    def snapshot_contents_files(self) -> Tuple[bytes, ...]:
+        """Contents of the .toc/.lof/.lot files the next pass would read back"""
+        snapshot = []
+        for ext in _CONTENTS_EXTENSIONS:
+            try:
+                snapshot.append(Path(self.temp_dir, f"document.{ext}").read_bytes())
+            except OSError:
+                snapshot.append(b"")
+        return tuple(snapshot)
+
+    async def needs_rerun(self, contents_before: Tuple[bytes, ...]) -> bool:
+        """Whether the last pass left references or contents lists unresolved"""
+        if _RERUN_RE.search(await self.read_log_tail()):
+            return True
+        return self.snapshot_contents_files() != contents_before
+
     async def read_pdf_file(self) -> bytes:
         """Read generated PDF file"""
         if not os.path.exists(self.pdf_file):
@@ -145,46 +415,238 @@ class LatexCompiler:
         except Exception as e:
             raise CompilationError(f"Failed to read PDF file: {str(e)}")
 
-async def compile_latex(tex_content: str) -> Dict[str, Any]:
-    """Main compilation function with proper error handling and validation"""
-    with tempfile.TemporaryDirectory() as temp_dir:
-        compiler = LatexCompiler(temp_dir)
+    async def verify_pdf_file(self) -> int:
+        """Check that a non-empty PDF was generated, returning its size"""
+        if not os.path.exists(self.pdf_file):
+            raise CompilationError("PDF file was not generated")
+
+        size = os.path.getsize(self.pdf_file)
+        if size == 0:
+            raise CompilationError("Generated PDF file is empty")
+        return size
+
+    async def link_pdf_file(self, dest_dir: str) -> str:
+        """Hard-link generated PDF into another directory, returning the new path"""
+        await self.verify_pdf_file()
+
+        try:
+            pdf_path = os.path.join(dest_dir, f"{uuid.uuid4().hex}.pdf")
+            try:
+                os.link(self.pdf_file, pdf_path)
+            except OSError as e:
+                # Uncached PDFs still sit in a tmpfs working directory
+                if e.errno != errno.EXDEV:
+                    raise
+                await asyncio.to_thread(shutil.copyfile, self.pdf_file, pdf_path)
+            return pdf_path
+        except Exception as e:
+            raise CompilationError(f"Failed to link PDF file: {str(e)}")
+
+def _prepare_tex_content(content: str) -> str:
+    content = LatexCompiler.validate_tex_content(content)
+    return LatexCompiler.ensure_document_structure(content)
+
+_prepare_tex_content_cached = functools.lru_cache(maxsize=PREPARE_CACHE_SIZE)(_prepare_tex_content)
+
+def prepare_tex_content(content: str) -> str:
+    """Clean LaTeX content and complete its document structure, memoised"""
+    if len(content) > PREPARE_CACHE_MAX_LENGTH:
+        return _prepare_tex_content(content)
+    return _prepare_tex_content_cached(content)
+
+class PdfCache:
+    """LRU cache of compiled PDFs and their logs, keyed by a hash of the source
+
+    Each entry is a directory holding ``document.pdf`` and ``document.log`` so
+    it can be read through a ``LatexCompiler`` like a fresh working directory.
+    """
+    def __init__(self, root: str, maxsize: int, max_bytes: Optional[int] = None):
+        self.root = root
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.cache_dir: Optional[str] = None
+        self._entries: OrderedDict[bytes, Tuple[LatexCompiler, int]] = OrderedDict()
+        self._total_bytes = 0
+
+    @staticmethod
+    def key(tex_content: str) -> bytes:
+        return hashlib.blake2b(tex_content.encode('utf-8'), digest_size=16).digest()
+
+    def open(self):
+        """Create the cache directory and size its byte budget if not configured"""
+        os.makedirs(self.root, exist_ok=True)
+        self.cache_dir = tempfile.mkdtemp(prefix="cache-", dir=self.root)
+        if self.max_bytes is None:
+            free = shutil.disk_usage(self.root).free
+            self.max_bytes = min(PDF_CACHE_DEFAULT_MAX_BYTES, int(free * PDF_CACHE_FREE_FRACTION))
+        logger.info(f"Caching up to {self.max_bytes} bytes of PDFs in {self.cache_dir}")
+
+    def close(self):
+        """Drop all entries and remove the cache directory"""
+        self._entries.clear()
+        self._total_bytes = 0
+        if self.cache_dir is not None:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            self.cache_dir = None
+
+    def get(self, key: bytes) -> Optional[LatexCompiler]:
+        """Return the cached compile for a key, marking it most recently used"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    async def put(self, key: bytes, compiler: LatexCompiler) -> LatexCompiler:
+        """Move a successful compile's PDF and log into the cache
+
+        Working directories may be on another filesystem (tmpfs), in which case
+        the move is a copy, so file work runs in a thread off the event loop.
+        """
+        size = await compiler.verify_pdf_file()
+        if self.cache_dir is None or self.max_bytes is None or size > self.max_bytes:
+            return compiler
+
+        # Each entry gets its own directory so concurrent puts of a key can't collide
+        cached = LatexCompiler(tempfile.mkdtemp(prefix=f"{key.hex()}-", dir=self.cache_dir))
+        try:
+            await asyncio.to_thread(shutil.move, compiler.pdf_file, cached.pdf_file)
+        except OSError as e:
+            logger.error(f"Failed to cache compiled PDF: {e}")
+            await asyncio.to_thread(shutil.rmtree, cached.temp_dir, ignore_errors=True)
+            return compiler
+
+        try:
+            if os.path.exists(compiler.log_file):
+                await asyncio.to_thread(shutil.move, compiler.log_file, cached.log_file)
+        except OSError as e:
+            logger.error(f"Failed to cache LaTeX log: {e}")
+
+        # Update the index without awaiting so it stays consistent, then clean up
+        evicted = [self._evict(key)]
+        self._entries[key] = (cached, size)
+        self._total_bytes += size
+        while len(self._entries) > self.maxsize or self._total_bytes > self.max_bytes:
+            evicted.append(self._evict(next(iter(self._entries))))
+        for temp_dir in evicted:
+            if temp_dir is not None:
+                await asyncio.to_thread(shutil.rmtree, temp_dir, ignore_errors=True)
+        return cached
+
+    def _evict(self, key: bytes) -> Optional[str]:
+        """Drop an entry from the index, returning its directory for removal"""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        cached, size = entry
+        self._total_bytes -= size
+        return cached.temp_dir
+
+pdf_cache = PdfCache(PDF_CACHE_ROOT, PDF_CACHE_SIZE, PDF_CACHE_MAX_BYTES)
+
+async def build_pdf_result(
+    compiler: LatexCompiler,
+    want_raw: bool,
+    include_log: bool
+) -> Dict[str, Any]:
+    """Build the success payload for a compiled PDF"""
+    log_content = await compiler.read_log_file() if include_log else ""
+
+    if want_raw:
+        return {
+            "success": True,
+            "pdf_path": await compiler.link_pdf_file(work_dirs.output_dir),
+            "log": log_content
+        }
+
+    # Encode in a worker thread so large PDFs don't stall the event loop
+    pdf_content = await compiler.read_pdf_file()
+    pdf_base64 = await asyncio.to_thread(pybase64.b64encode_as_string, pdf_content)
+    return {
+        "success": True,
+        "pdf": pdf_base64,
+        "log": log_content
+    }
+
+async def compile_latex(
+    tex_content: str,
+    want_raw: bool = False,
+    include_log: bool = False
+) -> Dict[str, Any]:
+    """Main compilation function with proper error handling and validation
+
+    When ``want_raw`` is set the PDF is linked into the output directory and
+    its path is returned as ``pdf_path``; the caller must delete it once sent.
+    Otherwise it is base64-encoded under ``pdf`` for a JSON response.
+    The log of a successful compile is only read when ``include_log`` is set;
+    failures always carry it.
+    """
+    # Cheap checks first so rejected input is never hashed or compiled
+    try:
+        check_tex_length(tex_content)
+    except ValueError as e:
+        return {
+            "success": False,
+            "error": str(e),
+            "log": "",
+            "output": ""
+        }
+
+    cache_key = PdfCache.key(tex_content)
+    cached = pdf_cache.get(cache_key)
+    if cached is not None:
+        logger.info("Serving PDF from cache")
+        try:
+            return await build_pdf_result(cached, want_raw, include_log)
+        except CompilationError as e:
+            logger.error(f"Failed to serve cached PDF: {e.message}")
+
+    # Guard the cleaned source, since that is exactly what pdflatex will read
+    try:
+        tex_content = prepare_tex_content(tex_content)
+        check_tex_content(tex_content)
+    except ValueError as e:
+        return {
+            "success": False,
+            "error": str(e),
+            "log": "",
+            "output": ""
+        }
+
+    async with work_dirs.acquire() as (temp_dir, cpu):
+        compiler = LatexCompiler(temp_dir, cpu)
         
         try:
-            # Validate and clean input
-            tex_content = compiler.validate_tex_content(tex_content)
-            tex_content = compiler.ensure_document_structure(tex_content)
-            
             # Write content to file
             await compiler.write_tex_file(tex_content)
             
-            # Run pdflatex twice for references
-            for i in range(2):
+            # Run again only while the previous pass left references unresolved
+            for i in range(MAX_PDFLATEX_PASSES):
+                contents_before = compiler.snapshot_contents_files()
                 stdout, stderr, returncode = await compiler.run_pdflatex()
-                log_content = await compiler.read_log_file()
                 
                 if returncode != 0:
                     raise CompilationError(
                         "LaTeX compilation failed",
-                        log=log_content,
-                        output=stdout
+                        log=await compiler.read_log_file(),
+                        output=stdout.decode('utf-8', errors='replace')
                     )
+                if not await compiler.needs_rerun(contents_before):
+                    break
             
-            # Read the generated PDF
-            pdf_content = await compiler.read_pdf_file()
-            pdf_base64 = base64.b64encode(pdf_content).decode('utf-8')
-            
-            # Validate base64 output
+            # A zero exit code can still mean no PDF (e.g. no pages of output)
             try:
-                test_decode = base64.b64decode(pdf_base64[:100])
-            except Exception as e:
-                raise CompilationError("Generated invalid base64 data")
+                await compiler.verify_pdf_file()
+            except CompilationError as e:
+                raise CompilationError(
+                    e.message,
+                    log=await compiler.read_log_file(),
+                    output=stdout.decode('utf-8', errors='replace')
+                )
             
-            return {
-                "success": True,
-                "pdf": pdf_base64,
-                "log": await compiler.read_log_file()
-            }
+            # Keep the result for identical resubmissions, then respond from it
+            compiler = await pdf_cache.put(cache_key, compiler)
+            return await build_pdf_result(compiler, want_raw, include_log)
             
         except CompilationError as e:
             return {
@@ -205,7 +667,8 @@ async def compile_latex(tex_content: str) -> Dict[str, Any]:
 async def compile_document(
     request: Request,
     tex_content: str = Form(...),
-    accept: Optional[str] = Form(None)
+    accept: Optional[str] = Form(None),
+    include_log: bool = Form(False)
 ) -> Response:
     # Check both Accept header and form data for content type preference
     accept_header = request.headers.get('Accept')
@@ -215,7 +678,12 @@ async def compile_document(
         logger.info("Received compilation request")
         logger.info(f"Accept header: {accept}")
         
-        result = await compile_latex(tex_content)
+        want_pdf = accept == 'application/pdf'
+        result = await compile_latex(
+            tex_content,
+            want_raw=want_pdf,
+            include_log=include_log
+        )
         
         # Common CORS headers
         cors_headers = {
@@ -224,31 +692,22 @@ async def compile_document(
             'Access-Control-Allow-Headers': 'Content-Type, Accept'
         }
         
-        # Return PDF directly if requested and available
-        if (
-            accept == 'application/pdf' and
-            result.get('success') and
-            'pdf' in result
-        ):
-            try:
-                pdf_data = base64.b64decode(result['pdf'])
-                logger.info(f"Sending PDF response ({len(pdf_data)} bytes)")
-                
-                if not pdf_data:
-                    raise ValueError("Decoded PDF data is empty")
-                
-                return Response(
-                    content=pdf_data,
-                    headers={
-                        'Content-Type': 'application/pdf',
-                        'Content-Disposition': 'inline',
-                        'Content-Length': str(len(pdf_data)),
-                        **cors_headers
-                    }
-                )
-            except Exception as e:
-                logger.error(f"Failed to send PDF response: {e}")
-                # Fall through to JSON response
+        # Return PDF directly if requested and available; the file is streamed
+        # from disk in chunks rather than held in memory, and removed once the
+        # response has gone out
+        if result.get('success') and 'pdf_path' in result:
+            pdf_path = result['pdf_path']
+            logger.info(f"Sending PDF response ({os.path.getsize(pdf_path)} bytes)")
+
+            return FileResponse(
+                pdf_path,
+                media_type='application/pdf',
+                headers={
+                    'Content-Disposition': 'inline',
+                    **cors_headers
+                },
+                background=BackgroundTask(os.unlink, pdf_path)
+            )
         
         # Return JSON response
         logger.info("Sending JSON response")
@@ -0,0 +1,234 @@
+import asyncio
+import os
+
+import pytest
+
+import main
+from main import LatexCompiler, PdfCache, check_tex_content, check_tex_length, prepare_tex_content
+
+
+def test_validate_normalizes_line_endings_and_strips_control_characters():
+    content = "a\r\nb\rc\x00d\x1b\te\x7f\u00e9\n"
+    assert LatexCompiler.validate_tex_content(content) == "a\nb\ncd\te\x7f\u00e9"
+
+
+@pytest.mark.parametrize("content", ["", "   \n\t"])
+def test_validate_rejects_empty_content(content):
+    with pytest.raises(ValueError):
+        LatexCompiler.validate_tex_content(content)
+
+
+def test_structure_wraps_bare_content():
+    assert prepare_tex_content("Hello") == (
+        "\\documentclass{article}\n\n\\begin{document}\nHello\n\\end{document}"
+    )
+
+
+def test_structure_inserts_begin_document_after_last_preamble_command():
+    content = "\\documentclass{article}\n\\usepackage{x}\n\\newcommand{\\a}{b}\nbody"
+    assert LatexCompiler.ensure_document_structure(content) == (
+        "\\documentclass{article}\n\\usepackage{x}\n\\newcommand{\\a}{b}\n"
+        "\n\\begin{document}\nbody\n\\end{document}"
+    )
+
+
+def test_structure_handles_preamble_on_last_line_without_newline():
+    assert LatexCompiler.ensure_document_structure("\\documentclass{article}") == (
+        "\\documentclass{article}\n\\begin{document}\n\n\\end{document}"
+    )
+
+
+def test_structure_leaves_complete_documents_alone():
+    content = "  \\documentclass{article}\n\\begin{document}\nx\n\\end{document}"
+    assert LatexCompiler.ensure_document_structure(content) == content
+
+
+def test_structure_only_counts_documentclass_at_line_start():
+    assert LatexCompiler.ensure_document_structure("text \\documentclass{x}").startswith(
+        "\\documentclass{article}\n"
+    )
+
+
+def test_prepare_is_memoised_for_small_inputs_only():
+    main._prepare_tex_content_cached.cache_clear()
+    prepare_tex_content("memo")
+    prepare_tex_content("memo")
+    prepare_tex_content("x" * (main.PREPARE_CACHE_MAX_LENGTH + 1))
+    info = main._prepare_tex_content_cached.cache_info()
+    assert (info.hits, info.misses) == (1, 1)
+
+
+def test_length_check_rejects_oversized_input():
+    check_tex_length("x" * main.MAX_TEX_LENGTH)
+    with pytest.raises(ValueError):
+        check_tex_length("x" * (main.MAX_TEX_LENGTH + 1))
+
+
+@pytest.mark.parametrize("content", [
+    "\\input{/etc/passwd}",
+    "\\input /etc/passwd",
+    "\\input\"/etc/passwd\"",
+    "\\include{../secret}",
+    "\\@input{~/secret}",
+    "\\InputIfFileExists{chapters/../../secret}{}{}",
+    "\\openin5=x",
+    "\\immediate\\openout3=x",
+    "\\immediate\\write18{ls}",
+    "\\immediate\\write 18{ls}",
+    "100\\%\\write18{ls}",
+    "\\catcode`\\%=12 %\\write18{ls}",
+])
+def test_content_check_rejects_file_io(content):
+    with pytest.raises(ValueError):
+        check_tex_content(content)
+
+
+@pytest.mark.parametrize("content", [
+    "\\input{glyphtounicode}",
+    "\\input glyphtounicode \\pdfgentounicode=1",
+    "\\include{chapters/intro}",
+    "%\\input{/etc/passwd}\n% \\immediate\\write18{ls}",
+    "\\\\% \\write18{ls}",
+])
+def test_content_check_allows_relative_inputs_and_comments(content):
+    check_tex_content(content)
+
+
+def test_content_check_runs_after_control_characters_are_stripped():
+    with pytest.raises(ValueError):
+        check_tex_content(prepare_tex_content("\\inp\x01ut{/etc/passwd}"))
+
+
+def test_content_check_allows_similar_names():
+    check_tex_content(prepare_tex_content(
+        "\\usepackage{inputenc}\n\\includegraphics{a}\n\\write16{x}\n\\definecolor{a}{rgb}{0,0,0}"
+    ))
+
+
+def test_content_check_limits_macro_definitions(monkeypatch):
+    monkeypatch.setattr(main, "MAX_MACRO_DEFINITIONS", 2)
+    check_tex_content("\\def\\a{}\\let\\b\\a")
+    with pytest.raises(ValueError):
+        check_tex_content("\\def\\a{}\\let\\b\\a\\gdef\\c{}")
+
+
+def test_content_check_allows_file_io_when_enabled(monkeypatch):
+    monkeypatch.setattr(main, "ALLOW_FILE_IO", True)
+    check_tex_content("\\input{/etc/passwd}\\immediate\\write18{ls}")
+
+
+def make_compile(tmp_path, name, size):
+    compiler = LatexCompiler(str(tmp_path / name))
+    os.makedirs(compiler.temp_dir)
+    with open(compiler.pdf_file, "wb") as f:
+        f.write(b"%" * size)
+    with open(compiler.log_file, "w") as f:
+        f.write(name)
+    return compiler
+
+
+def open_cache(tmp_path, maxsize, max_bytes):
+    cache = PdfCache(str(tmp_path / "cache"), maxsize, max_bytes)
+    cache.open()
+    return cache
+
+
+def test_cache_evicts_least_recently_used_by_count(tmp_path):
+    cache = open_cache(tmp_path, 2, 1000)
+    for name in "abc":
+        asyncio.run(cache.put(name.encode(), make_compile(tmp_path, name, 10)))
+        if name == "b":
+            assert cache.get(b"a") is not None
+    assert cache.get(b"b") is None
+    assert cache.get(b"a") is not None and cache.get(b"c") is not None
+    assert sorted(os.listdir(cache.cache_dir)) == sorted(
+        os.path.basename(cache.get(key).temp_dir) for key in (b"a", b"c")
+    )
+    cache.close()
+
+
+def test_cache_evicts_by_bytes(tmp_path):
+    cache = open_cache(tmp_path, 10, 25)
+    for name in "abc":
+        asyncio.run(cache.put(name.encode(), make_compile(tmp_path, name, 10)))
+    assert cache.get(b"a") is None
+    assert cache.get(b"b") is not None and cache.get(b"c") is not None
+    cache.close()
+
+
+def test_cache_replaces_entry_for_same_key(tmp_path):
+    cache = open_cache(tmp_path, 10, 1000)
+    asyncio.run(cache.put(b"a", make_compile(tmp_path, "a1", 10)))
+    cached = asyncio.run(cache.put(b"a", make_compile(tmp_path, "a2", 20)))
+    assert cache.get(b"a") is cached
+    assert os.listdir(cache.cache_dir) == [os.path.basename(cached.temp_dir)]
+    assert cache._total_bytes == 20
+    cache.close()
+
+
+def test_cache_skips_pdfs_larger_than_budget(tmp_path):
+    cache = open_cache(tmp_path, 10, 25)
+    compiler = make_compile(tmp_path, "big", 30)
+    assert asyncio.run(cache.put(b"big", compiler)) is compiler
+    assert cache.get(b"big") is None
+    assert os.path.exists(compiler.pdf_file)
+    cache.close()
+
+
+def test_cache_moves_pdf_and_log(tmp_path):
+    cache = open_cache(tmp_path, 10, 1000)
+    compiler = make_compile(tmp_path, "a", 10)
+    cached = asyncio.run(cache.put(b"a", compiler))
+    assert not os.path.exists(compiler.pdf_file)
+    assert asyncio.run(cached.read_log_file()) == "a"
+    cache.close()
+
+
+def test_linked_pdf_survives_eviction(tmp_path):
+    cache = open_cache(tmp_path, 1, 1000)
+    cached = asyncio.run(cache.put(b"a", make_compile(tmp_path, "a", 10)))
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    pdf_path = asyncio.run(cached.link_pdf_file(str(out_dir)))
+    assert os.stat(pdf_path).st_ino == os.stat(cached.pdf_file).st_ino
+    asyncio.run(cache.put(b"b", make_compile(tmp_path, "b", 10)))
+    assert cache.get(b"a") is None
+    assert os.path.getsize(pdf_path) == 10
+    cache.close()
+
+
+def test_compile_serves_repeat_requests_from_cache(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    calls = tmp_path / "calls"
+    stub = bin_dir / "pdflatex"
+    stub.write_text(
+        "#!/bin/sh\n"
+        f"echo run >> '{calls}'\n"
+        "printf '%%PDF-1.5 stub' > document.pdf\n"
+        "echo 'Output written on document.pdf' > document.log\n"
+    )
+    stub.chmod(0o755)
+    monkeypatch.setattr(main, "_PDFLATEX_ENV", {
+        **main._PDFLATEX_ENV, "PATH": f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+    })
+    monkeypatch.setattr(main, "work_dirs", main.WorkDirPool(
+        str(tmp_path / "pool"), [None], str(tmp_path / "cache")
+    ))
+    monkeypatch.setattr(main, "pdf_cache", PdfCache(str(tmp_path / "cache"), 4, 1000))
+
+    async def compile_twice():
+        main.work_dirs.open()
+        main.pdf_cache.open()
+        try:
+            first = await main.compile_latex("Hello", want_raw=True)
+            second = await main.compile_latex("Hello", want_raw=True)
+        finally:
+            main.work_dirs.close()
+            main.pdf_cache.close()
+        return first, second
+
+    first, second = asyncio.run(compile_twice())
+    assert first["success"] and second["success"]
+    assert first["pdf_path"] != second["pdf_path"]
+    assert calls.read_text() == "run\n"